@@ -103,6 +103,11 @@ class Hook:
     def hook_cmdline_binary(self, function):
         return self._hook_cmdline("binary", function)
 
+    # Check whether a command line hook is registered for the given tool,
+    # so hot paths can skip the dispatch entirely when there is none
+    def has_cmdline_hook(self, hook_type):
+        return self._cmdline_hooks.has_key(hook_type)
+
     # Return the command line after applying the hook
     def _get_cmdline(self, hook_type, cmdline):
         if self._cmdline_hooks.has_key(hook_type):
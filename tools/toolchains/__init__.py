@@ -261,6 +261,9 @@ class mbedToolchain:
         self.build_dir = None
         self.timestamp = time()
 
+        # Memoized include response files, keyed on the include set
+        self._inc_files = {}
+
         # Output build naming based on target+toolchain combo (mbed 2.0 builds)
         self.obj_path = join("TARGET_"+target.name, "TOOLCHAIN_"+self.name)
 
@@ -586,15 +589,23 @@ class mbedToolchain:
         return join(obj_dir, name + '.o')
 
     def get_inc_file(self, includes):
-        include_file = join(self.build_dir, ".includes_%s.txt" % self.inc_md5)
+        # Response files are shared between translation units with the same
+        # include set: name them by content hash and memoize the resolved
+        # path, so each distinct set is written (and stat'ed) only once
+        key = tuple(includes)
+        include_file = self._inc_files.get(key)
+        if include_file is not None:
+            return include_file
+        include_file = join(self.build_dir, ".includes_%s.txt" % md5(' '.join(key)).hexdigest())
         if not exists(include_file):
             with open(include_file, "wb") as f:
                 cmd_list = []
                 for c in includes:
                     if c:
-                        cmd_list.append(('-I%s' % c).replace("\\", "/"))                    
+                        cmd_list.append(('-I%s' % c).replace("\\", "/"))
                 string = " ".join(cmd_list)
                 f.write(string)
+        self._inc_files[key] = include_file
         return include_file
 
     def compile_sources(self, resources, build_path, inc_dirs=None):
@@ -614,6 +625,8 @@ class mbedToolchain:
         self.inc_md5 = md5(' '.join(inc_paths)).hexdigest()
         # Where to store response files
         self.build_dir = build_path
+        # Response files are cached per build directory
+        self._inc_files = {}
 
         objects = []
         queue = []
@@ -642,7 +655,7 @@ class mbedToolchain:
 
         # Use queues/multiprocessing if cpu count is higher than setting
         jobs = self.jobs if self.jobs else cpu_count()
-        if jobs > CPU_COUNT_MIN and len(queue) > jobs:
+        if jobs > CPU_COUNT_MIN and len(queue) > CPU_COUNT_MIN:
             return self.compile_queue(queue, objects)
         else:
             return self.compile_seq(queue, objects)
@@ -665,7 +678,7 @@ class mbedToolchain:
 
     def compile_queue(self, queue, objects):
         jobs_count = int(self.jobs if self.jobs else cpu_count())
-        p = Pool(processes=jobs_count)
+        p = Pool(processes=min(jobs_count, len(queue)))
 
         results = []
         for i in range(len(queue)):
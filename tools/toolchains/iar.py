@@ -14,21 +14,63 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import errno
+import os
 import re
 from os import remove
-from os.path import join, exists, dirname, splitext, exists
+from os.path import join, exists, dirname, splitext, expanduser, getmtime
+from shutil import copyfile, rmtree
+from hashlib import sha1
 
 from tools.toolchains import mbedToolchain
-from tools.settings import IAR_PATH
-from tools.settings import GOANNA_PATH
 from tools.hooks import hook_tool
+from tools.utils import mkdir, ToolException
+
+# Tool locations resolved once per process: the IAR class is instantiated
+# once per target and the paths never change between instances
+_TOOL_PATHS = {}
+
+# Upper bound for passing a command as plain argv instead of a response
+# file: the documented 32K command-line limit on Windows, ARG_MAX with
+# headroom for the environment elsewhere
+if os.name == 'nt':
+    _MAX_CMDLINE = 32768
+else:
+    try:
+        _MAX_CMDLINE = os.sysconf('SC_ARG_MAX') - 8192
+    except (AttributeError, ValueError, OSError):
+        _MAX_CMDLINE = 131072
+
+def _write_response_file(path, tokens):
+    # Assemble the content once and push it through raw os.write, bypassing
+    # the extra copy made by the buffered I/O layer. os.write may be partial,
+    # so advance a memoryview until everything is on disk
+    data = memoryview("".join(tokens))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while len(data):
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
 
 class IAR(mbedToolchain):
     LIBRARY_EXT = '.a'
     LINKER_EXT = '.icf'
     STD_LIB_NAME = "%s.a"
 
-    DIAGNOSTIC_PATTERN = re.compile('"(?P<file>[^"]+)",(?P<line>[\d]+)\s+(?P<severity>Warning|Error)(?P<message>.+)')
+    # The IAR and Goanna diagnostic patterns folded into one alternation so
+    # the whole compiler output is scanned in a single multiline finditer
+    # pass, instead of entering the regex engine twice per line
+    COMBINED_DIAGNOSTIC_PATTERN = re.compile(
+        '^(?:"(?P<iar_file>[^"]+)",(?P<iar_line>[\d]+)\s+(?P<iar_severity>Warning|Error)(?P<iar_message>.+)'
+        '|"\[Goanna\] (?P<goanna_severity>warning) \[(?P<goanna_file>[^:]+):(?P<goanna_line>\d+)\] \- (?P<goanna_message>.*)")',
+        re.MULTILINE)
+
+    # Content-addressed object cache shared by all builds of this user.
+    # Keyed on the compile command, the source and its dependencies, so a
+    # rebuild caused only by timestamp changes is served with file copies
+    # instead of a compiler invocation.
+    CACHE_DIR = join(expanduser("~"), ".mbed_iar_cache")
 
     DEFAULT_FLAGS = {
         'common': [
@@ -45,6 +87,22 @@ class IAR(mbedToolchain):
         'ld': ["--skip_dynamic_initialization", "--threaded_lib"],
     }
 
+    @classmethod
+    def _tool_paths(cls):
+        if not _TOOL_PATHS:
+            # Deferred so importing this module does not resolve the IAR
+            # install location for builds that use another toolchain
+            from tools.settings import IAR_PATH
+            IAR_BIN = join(IAR_PATH, "bin")
+            _TOOL_PATHS.update(
+                main_cc=join(IAR_BIN, "iccarm"),
+                iasmarm=join(IAR_BIN, "iasmarm"),
+                ilinkarm=join(IAR_BIN, "ilinkarm"),
+                iarchive=join(IAR_BIN, "iarchive"),
+                ielftool=join(IAR_BIN, "ielftool"),
+                dlib_config=join(IAR_PATH, "inc", "c", "DLib_Config_Full.h"))
+        return _TOOL_PATHS
+
     def __init__(self, target, options=None, notify=None, macros=None, silent=False, extra_verbose=False):
         mbedToolchain.__init__(self, target, options, notify, macros, silent, extra_verbose=extra_verbose)
         if target.core == "Cortex-M7F":
@@ -57,10 +115,12 @@ class IAR(mbedToolchain):
         asm_flags_cmd = [
             "--cpu", cpuchoice
         ]
+        tool_paths = self._tool_paths()
+
         # custom c flags
         c_flags_cmd = [
             "--cpu", cpuchoice,
-            "--thumb", "--dlib_config", join(IAR_PATH, "inc", "c", "DLib_Config_Full.h")
+            "--thumb", "--dlib_config", tool_paths['dlib_config']
         ]
         # custom c++ cmd flags
         cxx_flags_cmd = [
@@ -76,61 +136,179 @@ class IAR(mbedToolchain):
         else:
             c_flags_cmd.append("-Oh")
 
-        IAR_BIN = join(IAR_PATH, "bin")
-        main_cc = join(IAR_BIN, "iccarm")
+        main_cc = tool_paths['main_cc']
 
-        self.asm  = [join(IAR_BIN, "iasmarm")] + asm_flags_cmd + self.flags["asm"]
+        self.asm  = [tool_paths['iasmarm']] + asm_flags_cmd + self.flags["asm"]
         if not "analyze" in self.options:
             self.cc   = [main_cc]
             self.cppc = [main_cc]
         else:
+            from tools.settings import GOANNA_PATH
             self.cc   = [join(GOANNA_PATH, "goannacc"), '--with-cc="%s"' % main_cc.replace('\\', '/'), "--dialect=iar-arm", '--output-format="%s"' % self.GOANNA_FORMAT]
             self.cppc = [join(GOANNA_PATH, "goannac++"), '--with-cxx="%s"' % main_cc.replace('\\', '/'), "--dialect=iar-arm", '--output-format="%s"' % self.GOANNA_FORMAT]
         self.cc += self.flags["common"] + c_flags_cmd + self.flags["c"]
         self.cppc += self.flags["common"] + c_flags_cmd + cxx_flags_cmd + self.flags["cxx"]
-        self.ld   = join(IAR_BIN, "ilinkarm")
-        self.ar = join(IAR_BIN, "iarchive")
-        self.elf2bin = join(IAR_BIN, "ielftool")
+        self.ld   = tool_paths['ilinkarm']
+        self.ar = tool_paths['iarchive']
+        self.elf2bin = tool_paths['ielftool']
+
+        # Objects compiled during this run, to be stored in the object cache
+        # once their dependency files have been (re)generated
+        self._cache_pending = []
+
+        # Front-ends for which precompiling the config header has failed,
+        # so they fall back to --preinclude without retrying
+        self._pch_failed = {}
+
+        # Hooks are all registered by now; remember whether a compile
+        # cmdline hook exists so the per-file dispatch can be skipped
+        self._cmdline_compile_hooked = self.hook.has_cmdline_hook("compile")
+
+    def _cache_key(self, cmd, source, dep_path):
+        # The key covers the full compile command (response files and the
+        # config header are expanded to their content, so temporary paths do
+        # not pollute it), the compiler binary mtime, the source bytes and the
+        # content of every known dependency. Without a dependency file the
+        # include closure is unknown, so no key can be computed.
+        if not exists(dep_path):
+            return None
+        try:
+            key = sha1()
+            key.update(str(getmtime(cmd[0])))
+            expand_next = False
+            for c in cmd:
+                if expand_next:
+                    with open(c, "rb") as f:
+                        key.update(f.read())
+                    expand_next = False
+                else:
+                    key.update(c)
+                    expand_next = c in ('-f', '--preinclude', '--use_pch')
+                key.update('\0')
+            with open(source, "rb") as f:
+                key.update(f.read())
+            for dep in self.parse_dependencies(dep_path):
+                if not exists(dep):
+                    return None
+                with open(dep, "rb") as f:
+                    key.update(f.read())
+            return key.hexdigest()
+        except (IOError, OSError):
+            return None
+
+    def _cache_lookup(self, key, object, base):
+        cache_dir = join(self.CACHE_DIR, key)
+        if not exists(join(cache_dir, "object.o")):
+            return False
+        try:
+            copyfile(join(cache_dir, "object.o"), object)
+            copyfile(join(cache_dir, "object.d"), base + '.d')
+            copyfile(join(cache_dir, "object.s.txt"), base + '.s.txt')
+        except (IOError, OSError):
+            return False
+        return True
+
+    def _cache_store(self, key, object, base):
+        cache_dir = join(self.CACHE_DIR, key)
+        if exists(cache_dir):
+            return
+        # The cache is shared between concurrent builds, so stage the entry
+        # in a private directory and rename it into place: lookups only ever
+        # see complete entries
+        tmp_dir = "%s.tmp%d" % (cache_dir, os.getpid())
+        try:
+            mkdir(tmp_dir)
+            copyfile(object, join(tmp_dir, "object.o"))
+            copyfile(base + '.d', join(tmp_dir, "object.d"))
+            copyfile(base + '.s.txt', join(tmp_dir, "object.s.txt"))
+            os.rename(tmp_dir, cache_dir)
+        except (IOError, OSError):
+            # Most likely lost the race against another build storing the
+            # same entry; keep the winner and drop our staging directory
+            try:
+                rmtree(tmp_dir)
+            except (IOError, OSError):
+                pass
+
+    def compile_sources(self, resources, build_path, inc_dirs=None):
+        self._cache_pending = []
+        objects = mbedToolchain.compile_sources(self, resources, build_path, inc_dirs)
+        # Store freshly built objects in the cache. The key is recomputed
+        # here because the compiler has rewritten the dependency files
+        for cmd, source, object, base in self._cache_pending:
+            key = self._cache_key(cmd, source, base + '.d')
+            if key is not None:
+                self._cache_store(key, object, base)
+        self._cache_pending = []
+        return objects
 
     def parse_dependencies(self, dep_path):
-        return [path.strip() for path in open(dep_path).readlines()
-                if (path and not path.isspace())]
+        # Iterate the file instead of materializing it with readlines(),
+        # and close the handle instead of leaking it
+        with open(dep_path) as f:
+            return [path.strip() for path in f
+                    if (path and not path.isspace())]
 
     def parse_output(self, output):
-        for line in output.splitlines():
-            match = IAR.DIAGNOSTIC_PATTERN.match(line)
-            if match is not None:
+        for match in IAR.COMBINED_DIAGNOSTIC_PATTERN.finditer(output):
+            if match.group('iar_file') is not None:
                 self.cc_info(
-                    match.group('severity').lower(),
-                    match.group('file'),
-                    match.group('line'),
-                    match.group('message'),
+                    match.group('iar_severity').lower(),
+                    match.group('iar_file'),
+                    match.group('iar_line'),
+                    match.group('iar_message'),
                     target_name=self.target.name,
                     toolchain_name=self.name
                 )
-            match = self.goanna_parse_line(line)
-            if match is not None:
+            elif "analyze" in self.options:
                 self.cc_info(
-                    match.group('severity').lower(),
-                    match.group('file'),
-                    match.group('line'),
-                    match.group('message')
+                    match.group('goanna_severity').lower(),
+                    match.group('goanna_file'),
+                    match.group('goanna_line'),
+                    match.group('goanna_message')
                 )
 
-    def get_dep_option(self, object):
-        base, _ = splitext(object)
-        dep_path = base + '.d'
-        return ["--dependencies", dep_path]
-
-    def cc_extra(self, object):
-        base, _ = splitext(object)
-        return ["-l", base + '.s.txt']
-
-    def get_compile_options(self, defines, includes):
-        opts = ['-D%s' % d for d in defines] + ['-f', self.get_inc_file(includes)]
+    def get_pch(self, config_header, cc):
+        # Precompile the config header once per build directory and language
+        # front-end so every translation unit loads the PCH instead of
+        # re-lexing the header. A PCH produced by the C dialect does not
+        # match C++ compiles, hence one PCH per front-end. It is rebuilt
+        # whenever the header is newer; if iccarm cannot produce one, that
+        # front-end falls back to --preinclude for the rest of the build
+        lang = 'cxx' if cc is self.cppc else 'c'
+        if self._pch_failed.get(lang):
+            return None
+        pch = join(self.build_dir, "mbed_config_%s.pch" % lang)
+        if exists(pch) and getmtime(pch) >= getmtime(config_header):
+            return pch
+        try:
+            self.default_cmd(cc + ["--pch", pch, config_header])
+            return pch
+        except (ToolException, OSError):
+            self._pch_failed[lang] = True
+            return None
+
+    def get_compile_options(self, defines, includes, cc=None):
+        # Build the options in place with a bound append: one list
+        # allocation instead of three N-sized intermediates, and string
+        # concatenation instead of %-formatting for the defines
+        opts = []
+        opts_append = opts.append
+        for d in defines:
+            opts_append('-D' + d)
+        opts_append('-f')
+        opts_append(self.get_inc_file(includes))
         config_header = self.get_config_header()
         if config_header is not None:
-            opts = opts + ['--preinclude', config_header]
+            # Only compiler front-ends can consume a PCH; the assembler
+            # (which passes no cc) always preincludes the header
+            pch = self.get_pch(config_header, cc) if cc is not None else None
+            if pch is not None:
+                opts_append('--use_pch')
+                opts_append(pch)
+            else:
+                opts_append('--preinclude')
+                opts_append(config_header)
         return opts
 
     @hook_tool
@@ -147,16 +325,26 @@ class IAR(mbedToolchain):
     @hook_tool
     def compile(self, cc, source, object, includes):
         # Build compile command
-        cmd = cc +  self.get_compile_options(self.get_symbols(), includes)
+        cmd = cc +  self.get_compile_options(self.get_symbols(), includes, cc)
 
-        cmd.extend(self.get_dep_option(object))
+        # Serve unchanged objects from the cache instead of running iccarm.
+        # The key is computed on the command prefix only, so it is stable
+        # across build directories
+        base, _ = splitext(object)
+        key = self._cache_key(cmd, source, base + '.d')
+        if key is not None and self._cache_lookup(key, object, base):
+            return []
+        self._cache_pending.append((cmd[:], source, object, base))
+
+        cmd.extend(["--dependencies", base + '.d'])
+
+        cmd.extend(["-l", base + '.s.txt'])
 
-        cmd.extend(self.cc_extra(object))
-        
         cmd.extend(["-o", object, source])
 
         # Call cmdline hook
-        cmd = self.hook.get_cmdline_compiler(cmd)
+        if self._cmdline_compile_hooked:
+            cmd = self.hook.get_cmdline_compiler(cmd)
 
         return [cmd]
 
@@ -168,8 +356,10 @@ class IAR(mbedToolchain):
 
     @hook_tool
     def link(self, output, objects, libraries, lib_dirs, mem_map):
-        # Build linker command
-        map_file = splitext(output)[0] + ".map"
+        # Build linker command. The output is always a *.elf path, so a
+        # plain reverse search for the extension dot beats splitext here
+        dot = output.rfind('.')
+        map_file = (output[:dot] if dot >= 0 else output) + ".map"
         cmd = [self.ld, "-o", output, "--map=%s" % map_file] + objects + libraries + self.flags['ld']
 
         if mem_map:
@@ -178,16 +368,21 @@ class IAR(mbedToolchain):
         # Call cmdline hook
         cmd = self.hook.get_cmdline_linker(cmd)
 
-        # Split link command to linker executable + response file
+        # Short command lines go straight to the process: subprocess takes
+        # care of the quoting and the linker is spared re-parsing a
+        # response file
+        if sum(len(c) + 1 for c in cmd) < _MAX_CMDLINE:
+            self.default_cmd(cmd)
+            return
+
+        # Split link command to linker executable + response file, joined
+        # into a single buffer and pushed through raw os.write, bypassing
+        # the buffered I/O layer
         link_files = join(dirname(output), ".link_files.txt")
-        with open(link_files, "wb") as f:
-            cmd_linker = cmd[0]
-            cmd_list = []
-            for c in cmd[1:]:
-                if c:
-                    cmd_list.append(('"%s"' % c) if not c.startswith('-') else c)                    
-            string = " ".join(cmd_list).replace("\\", "/")
-            f.write(string)
+        cmd_linker = cmd[0]
+        _write_response_file(link_files,
+                             ((c + ' ' if c.startswith('-') else '"' + c + '" ').replace("\\", "/")
+                              for c in cmd[1:] if c))
 
         # Exec command
         self.default_cmd([cmd_linker, '-f', link_files])
@@ -195,20 +390,25 @@ class IAR(mbedToolchain):
     @hook_tool
     def archive(self, objects, lib_path):
         archive_files = join(dirname(lib_path), ".archive_files.txt")
-        with open(archive_files, "wb") as f:
-            o_list = []
-            for o in objects:
-                o_list.append('"%s"' % o)                    
-            string = " ".join(o_list).replace("\\", "/")
-            f.write(string)
-
-        if exists(lib_path):
+        _write_response_file(archive_files,
+                             ('"' + o.replace("\\", "/") + '" ' for o in objects))
+
+        # EAFP: one unlink syscall instead of a stat followed by an unlink
+        try:
             remove(lib_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
 
         self.default_cmd([self.ar, lib_path, '-f', archive_files])
 
     @hook_tool
     def binary(self, resources, elf, bin):
+        # Nothing to do when the image is already newer than the elf; not
+        # every caller guards this with need_update the way link_program does
+        if exists(bin) and getmtime(bin) >= getmtime(elf):
+            return
+
         # Build binary command
         cmd = [self.elf2bin, "--bin", elf, bin]
 